@@ -24,70 +24,42 @@
 # *
 # **************************************************************************
 
-import os
-import re
-
-import pwem
-import pyworkflow.utils as pwutils
+from typing import TYPE_CHECKING
 
+from . import constants
 from .constants import *
 
+if TYPE_CHECKING:
+    from ._plugin import Plugin
+
 
 __version__ = '3.10'
 _logo = "cistem_logo.png"
 _references = ['Grant2018']
+# constants are re-exported, as they were before Plugin became lazy
+__all__ = (["Plugin", "__version__", "_logo", "_references"] +
+           [name for name in vars(constants) if not name.startswith('_')])
 
+_PLUGIN = None
 
-class Plugin(pwem.Plugin):
-    _homeVar = CISTEM_HOME
-    _pathVars = [CISTEM_HOME, CTFFIND_HOME]
-    _supportedVersions = [V1_0_0]
-    _url = "https://github.com/scipion-em/scipion-em-cistem"
-
-    @classmethod
-    def _defineVariables(cls):
-        cls._defineEmVar(CISTEM_HOME, 'cistem-1.0.0-beta')
-        cls._defineEmVar(CTFFIND_HOME, 'ctffind-5.0.2')
-
-    @classmethod
-    def getActiveVersion(cls, *args):
-        """ Return the env name that is currently active. """
-        ctffind = cls.getVar(CTFFIND_HOME)
-        return re.search(r"ctffind-([0-9a-zA-Z.]+)$", ctffind).group(1)
 
-    @classmethod
-    def getEnviron(cls):
-        """ Setup the environment variables needed to launch cisTEM. """
-        environ = pwutils.Environ(os.environ)
-        environ.update({'PATH': cls.getHome()},
-                       position=pwutils.Environ.BEGIN)
+def _load():
+    """ Import the Scipion EM stack and the Plugin class only once,
+    on first access, so that reading the plugin metadata stays cheap. """
+    global _PLUGIN
+    if _PLUGIN is None:
+        from ._plugin import Plugin
+        _PLUGIN = Plugin
+    return _PLUGIN
 
-        return environ
 
-    @classmethod
-    def getProgram(cls, program):
-        """ Return the program binary that will be used. """
-        if program == CTFFIND_BIN:
-            # if CTFFIND_HOME is found, use it
-            path = cls.getVar(CTFFIND_HOME)
-            if os.path.exists(path):
-                binary = os.path.join(path, 'bin', program)
-            else:
-                binary = os.path.join(cls.getHome(), program)
-        else:
-            binary = os.path.join(cls.getHome(), program)
+def __getattr__(name):
+    if name == "Plugin":
+        return _load()
+    if name in {"getEnviron", "getProgram"}:
+        return getattr(_load(), name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
-        return binary
 
-    @classmethod
-    def defineBinaries(cls, env):
-        env.addPackage('cistem', version='1.0.0-beta',
-                       url="https://grigoriefflab.umassmed.edu/sites/default/files/cistem-1.0.0-beta-intel-linux.tar.gz",
-                       default=True)
-        env.addPackage('ctffind4', version='4.1.14',
-                       tar='ctffind4-4.1.14.tgz')
-        env.addPackage('ctffind', version='5.0',
-                       tar='ctffind-5.0.tgz')
-        env.addPackage('ctffind', version='5.0.2',
-                       tar='ctffind-5.0.2.tgz',
-                       default=True)
+def __dir__():
+    return sorted(set(globals()) | {"Plugin"})
@@ -0,0 +1,115 @@
+# **************************************************************************
+# *
+# *  Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import re
+from functools import lru_cache
+
+import pwem
+import pyworkflow.utils as pwutils
+
+from .constants import (CISTEM_HOME, CTFFIND_HOME, V1_0_0, CTFFIND_BIN,
+                        UNBLUR_BIN, FIND_PARTICLES_BIN)
+
+
+_CTFFIND_VER_RE = re.compile(r"ctffind-([0-9a-zA-Z.]+)$")
+
+
+@lru_cache(maxsize=4)
+def _extractVersion(ctffindHome):
+    """ Parse the ctffind version from its home folder name. """
+    return _CTFFIND_VER_RE.search(ctffindHome).group(1)
+
+
+# name, version and extra arguments of each installable package
+_PACKAGES = [
+    ('cistem', '1.0.0-beta',
+     {'url': "https://grigoriefflab.umassmed.edu/sites/default/files/cistem-1.0.0-beta-intel-linux.tar.gz",
+      'default': True}),
+    ('ctffind4', '4.1.14', {'tar': 'ctffind4-4.1.14.tgz'}),
+    ('ctffind', '5.0', {'tar': 'ctffind-5.0.tgz'}),
+    ('ctffind', '5.0.2', {'tar': 'ctffind-5.0.2.tgz', 'default': True}),
+]
+
+
+class Plugin(pwem.Plugin):
+    _homeVar = CISTEM_HOME
+    _pathVars = [CISTEM_HOME, CTFFIND_HOME]
+    _supportedVersions = [V1_0_0]
+    _url = "https://github.com/scipion-em/scipion-em-cistem"
+    _programs = {}  # resolved binaries, filled on first request
+
+    @classmethod
+    def _defineVariables(cls):
+        cls._defineEmVar(CISTEM_HOME, 'cistem-1.0.0-beta')
+        cls._defineEmVar(CTFFIND_HOME, 'ctffind-5.0.2')
+        # variables may have changed, drop anything resolved from them
+        cls._programs.clear()
+
+    @classmethod
+    def getActiveVersion(cls, *args):
+        """ Return the env name that is currently active. """
+        return _extractVersion(cls.getVar(CTFFIND_HOME))
+
+    @classmethod
+    def getEnviron(cls):
+        """ Setup the environment variables needed to launch cisTEM. """
+        environ = pwutils.Environ(os.environ)
+        environ.update({'PATH': cls.getHome()},
+                       position=pwutils.Environ.BEGIN)
+
+        return environ
+
+    @classmethod
+    def getProgram(cls, program):
+        """ Return the program binary that will be used.
+        The path is resolved only once per program and then cached. """
+        if not cls._programs:
+            cls._programs.update(cls._getBinIndex())
+        if program not in cls._programs:
+            cls._programs[program] = os.path.join(cls.getHome(), program)
+
+        return cls._programs[program]
+
+    @classmethod
+    def _getBinIndex(cls):
+        """ Map the known program names to their binaries,
+        looking up the home folders only once. """
+        home = cls.getHome()
+        index = {program: os.path.join(home, program)
+                 for program in (CTFFIND_BIN, UNBLUR_BIN, FIND_PARTICLES_BIN)}
+
+        # if CTFFIND_HOME is found, use it
+        ctffindHome = cls.getVar(CTFFIND_HOME)
+        if os.path.exists(ctffindHome):
+            index[CTFFIND_BIN] = os.path.join(ctffindHome, 'bin', CTFFIND_BIN)
+
+        return index
+
+    @classmethod
+    def defineBinaries(cls, env):
+        for name, version, kwargs in _PACKAGES:
+            env.addPackage(name, version=version, **kwargs)
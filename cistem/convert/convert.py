@@ -25,22 +25,45 @@
 # **************************************************************************
 
 import os
+import re
+import math
+import warnings
 import numpy as np
-from collections import OrderedDict
+from collections import namedtuple
 import logging
 logger = logging.getLogger(__name__)
 
 from pwem.objects import (Coordinate, SetOfClasses2D, SetOfAverages,
-                          Transform, CTFModel, Float)
+                          Transform, CTFModel, Float, Particle)
 from pwem.constants import ALIGN_PROJ
-from pwem.emlib.image import ImageHandler
-import pwem.convert.transformations as transformations
 from pyworkflow.utils import replaceBaseExt, exists
 
 
 HEADER_COLUMNS = ['INDEX', 'PSI', 'THETA', 'PHI', 'SHX', 'SHY', 'MAG',
                   'FILM', 'DF1', 'DF2', 'ANGAST', 'PSHIFT', 'OCC',
                   'LogP', 'SIGMA', 'SCORE', 'CHANGE']
+# structured dtype of a par file row, fields are accessed by name
+PAR_DTYPE = np.dtype([(name, float) for name in HEADER_COLUMNS])
+# lightweight par file row, fields are accessed by name (row.DF1)
+ParRow = namedtuple('ParRow', HEADER_COLUMNS)
+
+# last two values of the "image #N = x, y" lines of unblur logs
+_SHIFTS_RE = re.compile(rb'^[ \t]*image #.*[ \t](\S+?),?[ \t]+(\S+)[ \t]*\r?$',
+                        re.M)
+
+
+def makeParRow(values):
+    """ Build a ParRow from the values of a par file line.
+    Short rows, e.g. from older 16-column par files, are padded
+    with None and extra values are ignored.
+    :param values: sequence of values of a row
+    :return: a ParRow
+    """
+    values = tuple(values)[:len(HEADER_COLUMNS)]
+    if len(values) < len(HEADER_COLUMNS):
+        values += (None,) * (len(HEADER_COLUMNS) - len(values))
+
+    return ParRow._make(values)
 
 
 class FrealignParFile(object):
@@ -50,18 +73,41 @@ class FrealignParFile(object):
         self._count = 0
 
     def __iter__(self):
-        """ Convert a line into a dict with HEADER_COLUMNS as keys.
-        :return: yield a dict - single row
+        """ Convert a line into a ParRow with HEADER_COLUMNS as fields.
+        :return: yield a ParRow - single row
         """
         for line in self._file:
             line = line.strip()
-            if not line.startswith('C'):
-                row = OrderedDict(zip(HEADER_COLUMNS, line.split()))
-                yield row
+            if line and not line.startswith('C'):
+                yield makeParRow(line.split())
 
     def close(self):
         self._file.close()
 
+    @staticmethod
+    def loadArray(filename):
+        """ Read all rows of a par file at once.
+        :param filename: input par file
+        :return: structured array with one row per particle and
+        HEADER_COLUMNS as field names (see PAR_DTYPE). Files with
+        fewer columns, e.g. older 16-column par files, only get
+        the fields of the columns present.
+        """
+        nCols = len(HEADER_COLUMNS)
+        with open(filename) as f:
+            for line in f:
+                if line.strip() and not line.startswith('C'):
+                    nCols = min(len(line.split()), nCols)
+                    break
+            else:
+                return np.empty(0, dtype=PAR_DTYPE)
+
+        dtype = PAR_DTYPE if nCols == len(HEADER_COLUMNS) else np.dtype(
+            [(name, float) for name in HEADER_COLUMNS[:nCols]])
+
+        return np.loadtxt(filename, dtype=dtype, comments='C', ndmin=1,
+                          usecols=range(nCols))
+
 
 def readSetOfParticles(inputSet, outputSet, parFileName):
     """ Iterate through the inputSet and the parFile lines
@@ -74,35 +120,74 @@ def readSetOfParticles(inputSet, outputSet, parFileName):
      :param outputSet: output set of particles to be populated
      :param parFileName: Frealign par file to read alignments
      """
-    # create dictionary that matches input particles with param file
-    samplingRate = inputSet.getSamplingRate()
-    parFile = FrealignParFile(parFileName)
-    partIter = iter(inputSet.iterItems(orderBy=['_micId', 'id'], direction='ASC'))
+    partIter = inputSet.iterItems(orderBy=['_micId', 'id'], direction='ASC')
+    _readParticles(partIter, inputSet.getSamplingRate(), outputSet, parFileName)
+
+
+def readStackParticles(stackFn, outputSet, parFileName):
+    """ Same as readSetOfParticles, when the input particles are
+     all the images of a single stack, in order. Only the stack
+     header is read, particles are created from their locations.
+     :param stackFn: input stack file
+     :param outputSet: output set of particles to be populated,
+     its sampling rate must be already set
+     :param parFileName: Frealign par file to read alignments
+     """
+    # imported here, the image library is slow to load
+    from pwem.emlib.image import ImageHandler
+    _, _, _, n = ImageHandler().getDimensions(stackFn)
+    particles = (Particle(location=(i, stackFn)) for i in range(1, n + 1))
+    _readParticles(particles, outputSet.getSamplingRate(), outputSet, parFileName)
 
-    for particle, row in zip(partIter, parFile):
-        particle.setTransform(rowToAlignment(row, samplingRate))
+
+def _readParticles(partIter, samplingRate, outputSet, parFileName):
+    """ Match particles with the par file rows and add them to outputSet. """
+    parArray = FrealignParFile.loadArray(parFileName)
+
+    angles = np.column_stack((parArray['PSI'], parArray['THETA'], parArray['PHI']))
+    shifts = np.zeros((len(parArray), 3))
+    # shifts are converted from Angstroms to px
+    invSampling = 1. / samplingRate
+    shifts[:, 0] = parArray['SHX'] * invSampling
+    shifts[:, 1] = parArray['SHY'] * invSampling
+    matrices = matricesFromGeometry(shifts, angles)
+
+    append = outputSet.append
+    for particle, row, M in zip(partIter, parArray, matrices):
+        alignment = Transform()
+        alignment.setMatrix(M)
+        particle.setTransform(alignment)
         # We assume that each particle have ctfModel
         # in order to be processed in Frealign
         # JMRT: Since the CTF will be set, we can setup
         # an empty CTFModel object
         if not particle.hasCTF():
             particle.setCTF(CTFModel())
-        rowToCtfModel(row, particle.getCTF())
-        outputSet.append(particle)
+        arrayRowToCtfModel(row, particle.getCTF())
+        append(particle)
     outputSet.setAlignment(ALIGN_PROJ)
 
 
 def rowToCtfModel(ctfRow, ctfModel):
     """ Convert a row to Scipion CTF model.
-    :param ctfRow: input row
+    :param ctfRow: input ParRow
     :param ctfModel: output model
     """
-    defocusU = float(ctfRow.get('DF1'))
-    defocusV = float(ctfRow.get('DF2'))
-    defocusAngle = float(ctfRow.get('ANGAST'))
+    defocusU = float(ctfRow.DF1)
+    defocusV = float(ctfRow.DF2)
+    defocusAngle = float(ctfRow.ANGAST)
     ctfModel.setStandardDefocus(defocusU, defocusV, defocusAngle)
 
 
+def arrayRowToCtfModel(row, ctfModel):
+    """ Same as rowToCtfModel, but for a row of FrealignParFile.loadArray.
+    :param row: input array row
+    :param ctfModel: output model
+    """
+    # plain floats, cheaper to store than numpy scalars
+    ctfModel.setStandardDefocus(*row[['DF1', 'DF2', 'ANGAST']].tolist())
+
+
 def parseCtffindOutput(filename, avrot=False):
     """ Retrieve defocus U, V and angle from the
     output file of the ctffind execution.
@@ -110,23 +195,38 @@ def parseCtffindOutput(filename, avrot=False):
     :param avrot: parse _avrot.txt file
     :return: an array with CTF values
     """
-    if os.path.exists(filename):
-        result = np.loadtxt(filename, dtype=float, comments='#')
-        if avrot:
-            # Reshape into a 3D array where each "block" of 6 lines forms one slice along the first axis
-            reshaped_data = result.reshape(-1, 6, result.shape[1])
-            # Apply the mask to the first line of each 6-line block
-            # See details at https://github.com/3dem/relion-devel/commit/fceb6f687a09151dd60fd6e0ca46289798223bab
-            mask = np.logical_and(reshaped_data[:, 0, :] >= 0.25, reshaped_data[:, 0, :] <= 0.28)
-            # Compute the sum of the absolute values of the second line where the mask is True
-            rotAvgArray = np.sum(np.abs(reshaped_data[:, 1, :]) * mask, axis=1)
-            return rotAvgArray
-        else:
-            return result
-    else:
+    try:
+        result = _loadCtffindTxt(filename)
+    except FileNotFoundError:
         logger.error(f"Warning: Missing file: {filename}")
+        return None
+
+    if avrot:
+        # Reshape into a 3D array where each "block" of 6 lines forms one slice along the first axis
+        reshaped_data = result.reshape(-1, 6, result.shape[1])
+        freq = reshaped_data[:, 0, :]
+        amp = reshaped_data[:, 1, :]
+        # Apply the mask to the first line of each 6-line block
+        # See details at https://github.com/3dem/relion-devel/commit/fceb6f687a09151dd60fd6e0ca46289798223bab
+        mask = (freq >= 0.25) & (freq <= 0.28)
+        # Sum the absolute values of the second line where the mask is True,
+        # in a single pass without the masked product temporary
+        rotAvgArray = np.einsum('ij,ij->i', np.abs(amp), mask.astype(amp.dtype))
+        return rotAvgArray
+    else:
+        return result
 
-    return None
+
+def _loadCtffindTxt(filename):
+    """ Read the values of a ctffind output file, skipping the comments.
+    Like np.loadtxt, a single row is returned as a 1D array.
+    """
+    with open(filename) as f:
+        rows = [line.split() for line in f
+                if not line.startswith('#') and not line.isspace()]
+    result = np.array(rows, dtype=float)
+
+    return result[0] if len(result) == 1 else result
 
 
 def setWrongDefocus(ctfModel):
@@ -157,18 +257,20 @@ def readCtfModelStack(ctfModel, ctfArray, rotAvgArray=None, item=0):
         setWrongDefocus(ctfModel)
         ctfFit, ctfResolution, ctfPhaseShift = -999, -999, 0
     else:
-        defocusU, defocusV, defocusAngle = values[1], values[2], values[3]
-        ctfPhaseShift, ctfFit, ctfResolution = values[4], values[5], values[6]
+        # plain floats, cheaper to store than numpy scalars
+        values = values.tolist()
+        defocusU, defocusV, defocusAngle = values[1:4]
+        ctfPhaseShift, ctfFit, ctfResolution = values[4:7]
         ctfModel.setStandardDefocus(defocusU, defocusV, defocusAngle)
 
         if len(values) == 10:
-            tiltAxis, tiltAngle, thickness = values[7], values[8], values[9]
+            tiltAxis, tiltAngle, thickness = values[7:10]
 
     ctfModel.setFitQuality(ctfFit)
     ctfModel.setResolution(ctfResolution)
 
     # Avoid creation of phaseShift
-    ctfPhaseShiftDeg = np.rad2deg(ctfPhaseShift)
+    ctfPhaseShiftDeg = math.degrees(ctfPhaseShift)
     if ctfPhaseShiftDeg != 0:
         ctfModel.setPhaseShift(ctfPhaseShiftDeg)
 
@@ -205,17 +307,11 @@ def readShiftsMovieAlignment(shiftFn):
     :param shiftFn: input file to parse
     :return: two lists with shift values
     """
-    with open(shiftFn, 'r') as f:
-        xshifts = []
-        yshifts = []
+    # opened as binary, fromregex needs bytes for a bytes pattern
+    with open(shiftFn, 'rb') as f:
+        shifts = np.fromregex(f, _SHIFTS_RE, dtype=[('x', float), ('y', float)])
 
-        for line in f:
-            line2 = line.strip()
-            if line2.startswith('image #'):
-                parts = line2.split()
-                xshifts.append(float(parts[-2].rstrip(',')))
-                yshifts.append(float(parts[-1]))
-    return xshifts, yshifts
+    return shifts['x'].tolist(), shifts['y'].tolist()
 
 
 def readSetOfCoordinates(workDir, micSet, coordSet):
@@ -226,7 +322,11 @@ def readSetOfCoordinates(workDir, micSet, coordSet):
     """
     for mic in micSet:
         micCoordFn = os.path.join(workDir, replaceBaseExt(mic.getFileName(), 'plt'))
-        readCoordinates(mic, micCoordFn, coordSet)
+        try:
+            values = _loadPltFile(micCoordFn)
+        except FileNotFoundError:
+            continue  # no coordinates for this micrograph
+        _appendCoordinates(mic, values, coordSet)
 
 
 def readCoordinates(mic, fn, coordsSet):
@@ -236,16 +336,26 @@ def readCoordinates(mic, fn, coordsSet):
     :param coordsSet: output set of coords
     """
     if exists(fn):
-        with open(fn, 'r') as f:
-            for line in f:
-                values = line.strip().split()
-                # plt coords are in Imagic style
-                x = float(values[1])
-                y = float(mic.getYDim() - float(values[0]))
-                coord = Coordinate()
-                coord.setPosition(x, y)
-                coord.setMicrograph(mic)
-                coordsSet.append(coord)
+        _appendCoordinates(mic, _loadPltFile(fn), coordsSet)
+
+
+def _loadPltFile(fn):
+    """ Read the coordinates columns of a .plt file. """
+    with warnings.catch_warnings():
+        # an empty file is fine, the micrograph has no particles
+        warnings.simplefilter('ignore', UserWarning)
+        return np.loadtxt(fn, dtype=float, usecols=(0, 1), ndmin=2)
+
+
+def _appendCoordinates(mic, values, coordsSet):
+    # plt coords are in Imagic style
+    xs = values[:, 1]
+    ys = mic.getYDim() - values[:, 0]
+    for x, y in zip(xs.tolist(), ys.tolist()):
+        coord = Coordinate()
+        coord.setPosition(x, y)
+        coord.setMicrograph(mic)
+        coordsSet.append(coord)
 
 
 def writeReferences(inputSet, outputFn):
@@ -253,43 +363,43 @@ def writeReferences(inputSet, outputFn):
     :param inputSet: the input SetOfParticles to be converted
     :param outputFn: where to write the output files.
     """
-    ih = ImageHandler()
-
-    def _convert(item, n):
-        index = n + 1
-        ih.convert(item, (index, outputFn))
-        item.setLocation(index, outputFn)
-
     if isinstance(inputSet, SetOfAverages):
-        for i, img in enumerate(inputSet):
-            _convert(img, i)
+        items = inputSet
     elif isinstance(inputSet, SetOfClasses2D):
-        for i, rep in enumerate(inputSet.iterRepresentatives()):
-            _convert(rep, i)
+        items = inputSet.iterRepresentatives()
     else:
         raise TypeError('Invalid object type: %s' % type(inputSet))
 
+    from pwem.emlib.image import ImageHandler
+    locations = [item.getLocation() for item in items]
+    ih = ImageHandler()
+
+    if (len({fn for _, fn in locations}) == 1 and
+            [index for index, _ in locations] == list(range(1, len(locations) + 1)) and
+            ih.getDimensions(locations[0][1])[3] == len(locations)):
+        # the references are a whole stack, convert it in one go
+        ih.convertStack(locations[0][1], outputFn)
+    else:
+        for index, location in enumerate(locations, start=1):
+            ih.convert(location, (index, outputFn))
+
 
 def rowToAlignment(alignmentRow, samplingRate):
     """ Return an Transform object representing the Alignment
     from a given parFile row.
-    :param alignmentRow: input row object
+    :param alignmentRow: input ParRow
     :param samplingRate: input pixel size
     :return Transform object
     """
-    angles = np.zeros(3)
-    shifts = np.zeros(3)
     alignment = Transform()
-    # PSI   THETA     PHI       SHX       SHY
-    angles[0] = float(alignmentRow.get('PSI'))
-    angles[1] = float(alignmentRow.get('THETA'))
-    angles[2] = float(alignmentRow.get('PHI'))
     # shifts are converted from Angstroms to px
-    shifts[0] = float(alignmentRow.get('SHX')) / samplingRate
-    shifts[1] = float(alignmentRow.get('SHY')) / samplingRate
-
-    M = matrixFromGeometry(shifts, angles)
-    alignment.setMatrix(M)
+    invSampling = 1. / samplingRate
+    # PSI   THETA     PHI       SHX       SHY
+    shifts = [float(alignmentRow.SHX) * invSampling,
+              float(alignmentRow.SHY) * invSampling, 0.]
+    angles = [float(alignmentRow.PSI), float(alignmentRow.THETA),
+              float(alignmentRow.PHI)]
+    alignment.setMatrix(matrixFromGeometry(shifts, angles))
 
     return alignment
 
@@ -297,16 +407,59 @@ def rowToAlignment(alignmentRow, samplingRate):
 def matrixFromGeometry(shifts, angles):
     """ Create the transformation matrix from given
     2D shifts in X and Y and the 3 euler angles.
+    Single particle version of matricesFromGeometry, the szyz
+    rotation is built in closed form and inverted by transposing.
     :param shifts: input list of shifts
     :param angles: input list of angles
     :return matrix
     """
-    radAngles = -np.deg2rad(angles)
+    ai, aj, ak = (math.radians(a) for a in angles[:3])
+    si, sj, sk = math.sin(ai), math.sin(aj), math.sin(ak)
+    ci, cj, ck = math.cos(ai), math.cos(aj), math.cos(ak)
+    cc, cs = ci * ck, ci * sk
+    sc, ss = si * ck, si * sk
+
+    # transposed szyz rotation, see matricesFromGeometry
+    M = np.array([[cj * cc - ss, -cj * cs - sc, sj * ci, 0.],
+                  [cj * sc + cs, -cj * ss + cc, sj * si, 0.],
+                  [-sj * ck, sj * sk, cj, 0.],
+                  [0., 0., 0., 1.]])
+    M[:3, 3] = M[:3, :3] @ np.asarray(shifts[:3], dtype=float)
+
+    return M
 
-    M = transformations.euler_matrix(
-        radAngles[0], radAngles[1], radAngles[2], 'szyz')
-    M[:3, 3] = -shifts[:3]
-    M = np.linalg.inv(M)
+
+def matricesFromGeometry(shifts, angles):
+    """ Vectorized version of matrixFromGeometry for N particles.
+    The szyz rotation is built in closed form and the rigid
+    transformation is inverted analytically (R^T, R^T * shifts).
+    :param shifts: (N, 3) array of shifts in px
+    :param angles: (N, 3) array of euler angles (psi, theta, phi) in deg
+    :return (N, 4, 4) array of matrices
+    """
+    # matrixFromGeometry negates the angles, and the szyz parity
+    # negates them back inside euler_matrix
+    ai, aj, ak = np.deg2rad(angles).T
+    si, sj, sk = np.sin(ai), np.sin(aj), np.sin(ak)
+    ci, cj, ck = np.cos(ai), np.cos(aj), np.cos(ak)
+    cc, cs = ci * ck, ci * sk
+    sc, ss = si * ck, si * sk
+
+    R = np.empty((len(angles), 3, 3))
+    R[:, 2, 2] = cj
+    R[:, 2, 1] = sj * si
+    R[:, 2, 0] = sj * ci
+    R[:, 1, 2] = sj * sk
+    R[:, 1, 1] = -cj * ss + cc
+    R[:, 1, 0] = -cj * cs - sc
+    R[:, 0, 2] = -sj * ck
+    R[:, 0, 1] = cj * sc + cs
+    R[:, 0, 0] = cj * cc - ss
+
+    M = np.zeros((len(angles), 4, 4))
+    M[:, :3, :3] = R.transpose(0, 2, 1)
+    M[:, :3, 3] = np.einsum('nij,nj->ni', M[:, :3, :3], shifts)
+    M[:, 3, 3] = 1.
 
     return M
 
@@ -316,8 +469,16 @@ def geometryFromMatrix(matrix):
     :param matrix: input matrix
     :return: two lists, shifts and angles
     """
-    matrix = np.linalg.inv(matrix)
-    shifts = -transformations.translation_from_matrix(matrix)
-    angles = -np.rad2deg(transformations.euler_from_matrix(matrix, axes='szyz'))
+    from pwem.convert.transformations import (euler_from_matrix,
+                                              translation_from_matrix)
+    # inverse of the rigid transform [R | t] is [R^T | -R^T * t]
+    Rt = matrix[:3, :3].T
+    inverse = np.identity(4)
+    inverse[:3, :3] = Rt
+    inverse[:3, 3] = -Rt @ matrix[:3, 3]
+    matrix = inverse
+    shifts = -translation_from_matrix(matrix)
+    # degrees, with the sign folded into the factor
+    angles = np.multiply(euler_from_matrix(matrix, axes='szyz'), -180.0 / math.pi)
 
     return shifts, angles
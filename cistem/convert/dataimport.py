@@ -27,22 +27,38 @@
 # **************************************************************************
 
 import os.path
+from functools import lru_cache
 
 import pyworkflow.utils as pwutils
-from pwem.objects import CTFModel, SetOfParticles
+from pwem.objects import CTFModel
 
-from .convert import (readCtfModel, readSetOfParticles,
+from .convert import (readCtfModel, readStackParticles,
                       readCtfModelStack, parseCtffindOutput)
 
 with pwutils.weakImport('tomo'):
     from tomo.objects import CTFTomo
 
 
+# PSD file suffixes, in order of priority
+PSD_SUFFIXES = ('_psd.mrc', '.mrc', '_ctf.mrcs', '.mrcs', '.ctf')
+
+
+@lru_cache(maxsize=1024)
+def _listDir(dirName):
+    """ Return the file names in a folder, listing it only once. """
+    try:
+        return frozenset(os.listdir(dirName or '.'))
+    except OSError:
+        return frozenset()
+
+
 class GrigorieffLabImportCTF:
     """ Import CTF estimated with CTFFIND. """
     def __init__(self, protocol):
         self.protocol = protocol
         self.copyOrLink = self.protocol.getCopyOrLink()
+        # new files may have been written since the last import
+        _listDir.cache_clear()
 
     def importCTF(self, mic, fileName):
         """ Create a CTF model and populate its values.
@@ -110,13 +126,12 @@ class GrigorieffLabImportCTF:
         """ Try to find the given PSD file associated with the cttfind log file
         We handle special cases of .ctf extension and _ctffind4 prefix for Relion runs
         """
-        for suffix in ['_psd.mrc', '.mrc', '_ctf.mrcs',
-                       '.mrcs', '.ctf']:
-            psdPrefixes = [fnBase,
-                           fnBase.replace('_ctffind4', '')]
-            for prefix in psdPrefixes:
-                psdFile = prefix + suffix
-                if os.path.exists(psdFile):
+        psdPrefixes = [os.path.split(fnBase),
+                       os.path.split(fnBase.replace('_ctffind4', ''))]
+        for suffix in PSD_SUFFIXES:
+            for dirName, baseName in psdPrefixes:
+                if baseName + suffix in _listDir(dirName):
+                    psdFile = os.path.join(dirName, baseName + suffix)
                     if psdFile.endswith('.ctf'):
                         psdFile += ':mrc'
                     return psdFile
@@ -146,16 +161,13 @@ class GrigorieffLabImportParticles:
         # Create a local link to the input stack file
         localStack = self.protocol._getExtraPath(os.path.basename(self.stackFile))
         pwutils.createLink(self.stackFile, localStack)
-        # Create a temporary set only with location
-        tmpSet = SetOfParticles(filename=':memory:')
-        tmpSet.readStack(localStack)
-        self._setupSet(tmpSet)
 
         # Update both samplingRate and acquisition with parameters
         # selected in the protocol form
         self._setupSet(partSet)
-        # Now read the alignment parameters from par file
-        readSetOfParticles(tmpSet, partSet, self.parFile)
+        # Now read the alignment parameters from par file,
+        # particles are taken in order from the stack
+        readStackParticles(localStack, partSet, self.parFile)
         partSet.setHasCTF(True)
         # Register the output set of particles
         self.protocol._defineOutputs(outputParticles=partSet)
@@ -26,7 +26,8 @@
 # *
 # **************************************************************************
 
-from numpy import deg2rad
+import math
+from collections import ChainMap
 
 from pwem.objects import CTFModel
 import pyworkflow.protocol.params as params
@@ -177,9 +178,8 @@ class ProgramCtffind:
         for one micrograph or group of micrographs.
         :return: the program and arguments to be run
         """
-        paramDict = dict(self._params)
-        paramDict.update(kwargs)
-        return self._program, self._args % paramDict
+        # look up kwargs first, without copying the params dict
+        return self._program, self._args % ChainMap(kwargs, self._params)
 
     def parseOutputAsCtf(self, ctfFn, rotAvgFn=None, psdFile=None):
         """ Parse the output file and build the CTFModel object
@@ -212,9 +212,9 @@ class ProgramCtffind:
 
         if self._findPhaseShift:
             paramDict['phaseShift'] = "yes"
-            paramDict['minPhaseShift'] = deg2rad(protocol.minPhaseShift.get())
-            paramDict['maxPhaseShift'] = deg2rad(protocol.maxPhaseShift.get())
-            paramDict['stepPhaseShift'] = deg2rad(protocol.stepPhaseShift.get())
+            paramDict['minPhaseShift'] = math.radians(protocol.minPhaseShift.get())
+            paramDict['maxPhaseShift'] = math.radians(protocol.maxPhaseShift.get())
+            paramDict['stepPhaseShift'] = math.radians(protocol.stepPhaseShift.get())
         else:
             paramDict['phaseShift'] = "no"
 
@@ -233,60 +233,43 @@ class ProgramCtffind:
         else:
             paramDict['measureThickness'] = "no"
 
-        args = """   << eof > %(ctffindOut)s
-%(micFn)s
-%(ctffindPSD)s
-%(samplingRate)f
-%(voltage)f
-%(sphericalAberration)f
-%(ampContrast)f
-%(windowSize)d
-%(lowRes)f
-%(highRes)f
-%(minDefocus)f
-%(maxDefocus)f
-%(step_focus)f
-no
-%(slowSearch)s
-%(fixAstig)s
-%(phaseShift)s
-%(measureTilt)s
-%(measureThickness)s
-no
-eof\n
-"""
-
-        if protocol.usePowerSpectra:
-            args = args.replace('<< eof > %(ctffindOut)s',
-                                '--amplitude-spectrum-input << eof > %(ctffindOut)s')
-            args = args.replace('%(samplingRate)f',
-                                '%(powerSpectraPix)f')
-
+        # answers to the ctffind prompts, in order
+        lines = ['%(micFn)s']
         if getattr(protocol, "useStacks", False):
-            args = args.replace('%(micFn)s',
-                                '%(micFn)s\n'
-                                'no')
-
+            lines.append('no')
+        lines += ['%(ctffindPSD)s',
+                  '%(powerSpectraPix)f' if protocol.usePowerSpectra else '%(samplingRate)f',
+                  '%(voltage)f',
+                  '%(sphericalAberration)f',
+                  '%(ampContrast)f',
+                  '%(windowSize)d',
+                  '%(lowRes)f',
+                  '%(highRes)f',
+                  '%(minDefocus)f',
+                  '%(maxDefocus)f',
+                  '%(step_focus)f',
+                  'no',
+                  '%(slowSearch)s',
+                  '%(fixAstig)s']
         if protocol.fixAstig:
-            args = args.replace('%(fixAstig)s',
-                                '%(fixAstig)s\n'
-                                '%(astigmatism)f')
-
+            lines.append('%(astigmatism)f')
+        lines.append('%(phaseShift)s')
         if self._findPhaseShift:
-            args = args.replace('%(phaseShift)s',
-                                '%(phaseShift)s\n'
-                                '%(minPhaseShift)f\n'
-                                '%(maxPhaseShift)f\n'
-                                '%(stepPhaseShift)f')
-
+            lines += ['%(minPhaseShift)f',
+                      '%(maxPhaseShift)f',
+                      '%(stepPhaseShift)f']
+        lines += ['%(measureTilt)s',
+                  '%(measureThickness)s']
         if tomo and protocol.measureThickness:
-            args = args.replace('%(measureThickness)s',
-                                '%(measureThickness)s\n'
-                                '%(search1D)s\n'
-                                '%(refine2D)s\n'
-                                '%(lowResNodes)s\n'
-                                '%(highResNodes)s\n'
-                                '%(useRoundedSquare)s\n'
-                                '%(downweightNodes)s')
+            lines += ['%(search1D)s',
+                      '%(refine2D)s',
+                      '%(lowResNodes)s',
+                      '%(highResNodes)s',
+                      '%(useRoundedSquare)s',
+                      '%(downweightNodes)s']
+        lines += ['no', 'eof\n\n']
+
+        spectrumArg = '--amplitude-spectrum-input ' if protocol.usePowerSpectra else ''
+        args = f'   {spectrumArg}<< eof > %(ctffindOut)s\n' + '\n'.join(lines)
 
         return args, paramDict
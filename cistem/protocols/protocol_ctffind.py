@@ -29,6 +29,7 @@
 # **************************************************************************
 
 import os
+import threading
 
 import pyworkflow.utils as pwutils
 from pyworkflow.constants import PROD
@@ -59,6 +60,7 @@ class CistemProtCTFFind(ProtCTFMicrographs):
     def _defineCtfParamsDict(self):
         ProtCTFMicrographs._defineCtfParamsDict(self)
         self._ctfProgram = ProgramCtffind(self)
+        self._threadLocal = threading.local()
 
     # -------------------------- STEPS functions ------------------------------
     def _doCtfEstimation(self, mic, **kwargs):
@@ -72,20 +74,19 @@ class CistemProtCTFFind(ProtCTFMicrographs):
         else:
             micFn = mic.getFileName()
             powerSpectraPix = None
+        if not os.path.exists(micFn):
+            raise FileNotFoundError("Missing input micrograph: %s" % micFn)
+
         micDir = self._getTmpPath('mic_%06d' % mic.getObjId())
         # Create micrograph dir
         pwutils.makePath(micDir)
         micFnMrc = os.path.join(micDir, pwutils.replaceBaseExt(micFn, 'mrc'))
 
-        ih = emlib.image.ImageHandler()
-
-        if not os.path.exists(micFn):
-            raise FileNotFoundError("Missing input micrograph: %s" % micFn)
-
+        # ctffind reads any mrc data type, only other formats are converted
         if micFn.endswith('.mrc'):
             pwutils.createAbsLink(os.path.abspath(micFn), micFnMrc)
         else:
-            ih.convert(micFn, micFnMrc, emlib.DT_FLOAT)
+            self._getImageHandler().convert(micFn, micFnMrc, emlib.DT_FLOAT)
 
         try:
             program, args = self._ctfProgram.getCommand(
@@ -109,7 +110,7 @@ class CistemProtCTFFind(ProtCTFMicrographs):
         """
         file = self._getCtfOutPath(mic)
         with open(file, "r") as fh:
-            for line in fh.readlines():
+            for line in fh:
                 if "Error:" in line:
                     return line.split("Error:")[-1]
         return e
@@ -150,7 +151,7 @@ class CistemProtCTFFind(ProtCTFMicrographs):
         valueMin = round(self.minPhaseShift.get(), 2)
         valueMax = round(self.maxPhaseShift.get(), 2)
 
-        if not (self.minPhaseShift < self.maxPhaseShift and
+        if not (valueMin < valueMax and
                 valueStep <= (valueMax - valueMin) and
                 0. <= valueMax <= 180.):
             errors.append('Wrong values for phase shift search.')
@@ -177,8 +178,7 @@ class CistemProtCTFFind(ProtCTFMicrographs):
         :param mic: input mic object
         :param suffix: file extension
         """
-        return self._getExtraPath(pwutils.removeBaseExt(os.path.basename(
-            mic.getFileName())) + '_' + suffix)
+        return self._getExtraPath(pwutils.removeBaseExt(mic.getFileName()) + '_' + suffix)
 
     def _getPsdPath(self, mic):
         return self._getMicExtra(mic, 'ctf.mrc')
@@ -196,6 +196,14 @@ class CistemProtCTFFind(ProtCTFMicrographs):
 
         return ctf
 
+    def _getImageHandler(self):
+        """ Reuse one ImageHandler per thread, since steps may run in parallel. """
+        ih = getattr(self._threadLocal, 'ih', None)
+        if ih is None:
+            ih = self._threadLocal.ih = emlib.image.ImageHandler()
+
+        return ih
+
     def _getFirstMic(self):
         """ Get first mic in the input set only once. """
         return self.getInputMicrographs().getFirstItem()
@@ -25,6 +25,8 @@
 # **************************************************************************
 
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import pyworkflow.protocol.params as params
 from pyworkflow.protocol import STEPS_PARALLEL
@@ -48,6 +50,9 @@ class CistemProtFindParticles(ProtParticlePickingAuto):
     def __init__(self, **kwargs):
         ProtParticlePickingAuto.__init__(self, **kwargs)
         self.stepsExecutionMode = STEPS_PARALLEL
+        # CTF values of the input mics, read on first use
+        self._ctfLock = threading.Lock()
+        self._ctfDict = {}
 
     # --------------------------- DEFINE param functions ------------------------
     def _defineParams(self, form):
@@ -200,39 +205,64 @@ class CistemProtFindParticles(ProtParticlePickingAuto):
 
         # Keep the micrographs that have CTF
         # and set the CTF property for those who have it
-        readyMics = dict()
+        readyMics = {micKey: mic for micKey, mic in micDict.items()
+                     if micKey in ctfDict}
 
-        for micKey, mic in micDict.items():
-            if micKey in ctfDict:
-                mic.setCTF(ctfDict[micKey])
-                readyMics[micKey] = mic
+        for micKey, mic in readyMics.items():
+            mic.setCTF(ctfDict[micKey])
 
         # Return the updated micDict and the closed status
         return readyMics, micClose and ctfClosed
 
     # --------------------------- STEPS functions -------------------------------
     def convertInputStep(self, micsId, refsId):
-        """ Match ctf information against the micrographs. """
-        self.ctfDict = {}
-        if self.ctfRelations.get() is not None:
-            for ctf in self.ctfRelations.get():
-                self.ctfDict[ctf.getMicrograph().getMicName()] = ctf.clone()
-
-        ih = emlib.image.ImageHandler()
+        """ Convert the input micrographs and write the references. """
+        toConvert = []
+        tmpDir = self._getTmpPath()
+        cwd = os.getcwd()
         for mic in self.getInputMicrographs():
             micName = mic.getFileName()
             # We convert the input micrographs if they are not .mrc
-            outMic = os.path.join(self._getTmpPath(),
-                                  pwutils.replaceBaseExt(micName, 'mrc'))
+            outMic = os.path.join(tmpDir, pwutils.replaceBaseExt(micName, 'mrc'))
             if micName.endswith('.mrc'):
-                pwutils.createAbsLink(os.path.abspath(micName), outMic)
-            else:
-                ih.convert(micName, outMic, emlib.DT_FLOAT)
+                micPath = os.path.normpath(os.path.join(cwd, micName))
+                # links from a previous run are kept if they are still valid
+                if not (os.path.islink(outMic) and os.readlink(outMic) == micPath):
+                    pwutils.createAbsLink(micPath, outMic)
+            elif not _isUpToDate(outMic, micName):
+                # converted mics are kept when resuming an interrupted run
+                toConvert.append((micName, outMic))
+
+        self._threadLocal = threading.local()
+        nThreads = self.numberOfThreads.get()
+        if nThreads > 1 and len(toConvert) > 1:
+            # conversions are independent, run them in parallel
+            with ThreadPoolExecutor(max_workers=nThreads) as executor:
+                list(executor.map(self._convertMic, *zip(*toConvert)))
+        else:
+            for micName, outMic in toConvert:
+                self._convertMic(micName, outMic)
 
         if refsId is not None:
             writeReferences(self.getInputReferences(),
                             self._getExtraPath('references.mrc'))
 
+    def _convertMic(self, micName, outMic):
+        """ Convert a micrograph to mrc. The output is renamed once
+        complete, so an interrupted conversion is never taken as up to date.
+        """
+        partialMic = pwutils.removeExt(outMic) + '_partial.mrc'
+        self._getImageHandler().convert(micName, partialMic, emlib.DT_FLOAT)
+        os.replace(partialMic, outMic)
+
+    def _getImageHandler(self):
+        """ Reuse one ImageHandler per thread, conversions run in parallel. """
+        ih = getattr(self._threadLocal, 'ih', None)
+        if ih is None:
+            ih = self._threadLocal.ih = emlib.image.ImageHandler()
+
+        return ih
+
     def _pickMicrograph(self, mic, *args):
         self._pickMicrographStep([mic], *args)
 
@@ -244,47 +274,62 @@ class CistemProtFindParticles(ProtParticlePickingAuto):
         :param mics: micrograph list
         :param args: programs args
         """
+        # the template and reference options are the same for all mics
+        argsStr = self._getArgsStr()
+        program, env = self._getProgram(), Plugin.getEnviron()
+        if self.pickType == 1:
+            args.update({
+                'refsFn': self._getExtraPath('references.mrc'),
+                'useRadAvg': 'YES' if self.useRadAvg else 'NO',
+                'rotateRef': self.rotateRef.get(),
+            })
+
         for mic in mics:
             micName = mic.getFileName()
             outMic = os.path.join(self._getTmpPath(),
                                   pwutils.replaceBaseExt(micName, 'mrc'))
-            ctf = self.ctfDict[mic.getMicName()]
+            phaseShift, defocusU, defocusV, defocusAngle = self._getCtfValues(mic)
+            logFn = self._getLogFn(mic)
+            stackFn = self._getStackFn(mic)
 
             args.update({'micName': outMic,
-                         'logFn': self._getLogFn(mic),
-                         'outStack': self._getStackFn(mic),
-                         'phaseShift': ctf.getPhaseShift() or 0.0,
-                         'defocusU': ctf.getDefocusU(),
-                         'defocusV': ctf.getDefocusV(),
-                         'defocusAngle': ctf.getDefocusAngle()
+                         'logFn': logFn,
+                         'outStack': stackFn,
+                         'phaseShift': phaseShift,
+                         'defocusU': defocusU,
+                         'defocusV': defocusV,
+                         'defocusAngle': defocusAngle
                          })
-
-            if self.pickType == 1:
-                args.update({
-                    'refsFn': self._getExtraPath('references.mrc'),
-                    'useRadAvg': 'YES' if self.useRadAvg else 'NO',
-                    'rotateRef': self.rotateRef.get(),
-                })
-
-            argsStr = self._getArgsStr()
             cmdArgs = argsStr % args
 
             try:
-                self.runJob(self._getProgram(), cmdArgs,
-                            env=Plugin.getEnviron())
+                self.runJob(program, cmdArgs, env=env)
 
                 # Move output coords from tmp to extra
-                pltFn = pwutils.replaceExt(self._getStackFn(mic), 'plt')
+                pltFn = pwutils.replaceExt(stackFn, 'plt')
                 pwutils.moveFile(pltFn, self._getPltFn(mic))
 
                 # Clean tmp folder
-                pwutils.cleanPath(outMic)
-                pwutils.cleanPath(self._getLogFn(mic))
-                pwutils.cleanPath(self._getStackFn(mic))
+                pwutils.cleanPath(outMic, logFn, stackFn)
             except Exception as e:
                 self.error("ERROR: Picking has failed for %s. %s" % (
                     outMic, self._getErrorFromPickerTxt(mic, e)))
 
+    def _getCtfValues(self, mic):
+        """ Return the CTF values passed to the picker for a mic. The input
+        CTFs are read on first use, and read again from the database only
+        when a mic is missing (new CTFs in streaming).
+        """
+        micName = mic.getMicName()
+        # picking steps run in parallel threads and share the CTF values
+        with self._ctfLock:
+            if micName not in self._ctfDict:
+                ctfDict, _ = self._loadCTFs(self.ctfRelations.get())
+                self._ctfDict = {micKey: _ctfValues(ctf)
+                                 for micKey, ctf in ctfDict.items()}
+
+            return self._ctfDict[micName]
+
     def _getErrorFromPickerTxt(self, mic, e):
         """ Parse output log for errors.
         :param mic: input mic object
@@ -292,7 +337,7 @@ class CistemProtFindParticles(ProtParticlePickingAuto):
         """
         file = self._getLogFn(mic)
         with open(file, "r") as fh:
-            for line in fh.readlines():
+            for line in fh:
                 if line.startswith("Error"):
                     return line.replace("Error:", "")
         return e
@@ -486,3 +531,18 @@ eof"""
 
     def getInputReferences(self):
         return self.inputRefs.get() if self.inputRefs.hasValue() else None
+
+
+def _ctfValues(ctf):
+    """ Return the CTF values passed to the picker, no need to
+    keep (and clone) the whole CTF model. """
+    return (ctf.getPhaseShift() or 0.0, ctf.getDefocusU(),
+            ctf.getDefocusV(), ctf.getDefocusAngle())
+
+
+def _isUpToDate(outFn, inFn):
+    """ Return True if outFn exists and is not older than inFn. """
+    try:
+        return os.stat(outFn).st_mtime >= os.stat(inFn).st_mtime
+    except FileNotFoundError:
+        return False
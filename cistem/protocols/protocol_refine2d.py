@@ -30,7 +30,6 @@ import os
 import re
 import sys
 from glob import glob
-from collections import OrderedDict
 from enum import Enum
 import asyncio
 
@@ -49,7 +48,7 @@ from pwem.objects import SetOfClasses2D
 
 from cistem import Plugin
 from ..convert import (writeReferences, geometryFromMatrix,
-                       rowToAlignment, HEADER_COLUMNS)
+                       rowToAlignment, makeParRow)
 
 
 class outputs(Enum):
@@ -695,13 +694,13 @@ class CistemProtRefine2D(ProtClassify2D):
                              iterParams=params)
 
     def _updateParticle(self, item, row):
-        vals = OrderedDict(zip(HEADER_COLUMNS, row))
-        item.setClassId(vals.get('FILM'))
+        vals = makeParRow(row)
+        item.setClassId(vals.FILM)
         item.setTransform(rowToAlignment(vals, item.getSamplingRate()))
-        item._cistemLogP = Float(vals.get('LogP'))
-        item._cistemSigma = Float(vals.get('SIGMA'))
-        item._cistemOCC = Float(vals.get('OCC'))
-        item._cistemScore = Float(vals.get('SCORE'))
+        item._cistemLogP = Float(vals.LogP)
+        item._cistemSigma = Float(vals.SIGMA)
+        item._cistemOCC = Float(vals.OCC)
+        item._cistemScore = Float(vals.SCORE)
 
     def _updateClass(self, item):
         classId = item.getObjId()
@@ -259,7 +259,7 @@ class CistemProtTsCtffind(EMProtocol):
         valueMin = round(self.minPhaseShift.get(), 2)
         valueMax = round(self.maxPhaseShift.get(), 2)
 
-        if not (self.minPhaseShift < self.maxPhaseShift and
+        if not (valueMin < valueMax and
                 valueStep <= (valueMax - valueMin) and
                 0. <= valueMax <= 180.):
             errors.append('Wrong values for phase shift search.')
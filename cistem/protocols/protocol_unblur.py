@@ -227,7 +227,7 @@ class CistemProtUnblur(ProtAlignMovies):
         """
         file = self._getShiftsFn(movie)
         with open(file, "r") as fh:
-            for line in fh.readlines():
+            for line in fh:
                 if line.startswith("Error"):
                     return line.replace("Error:", "")
         return e